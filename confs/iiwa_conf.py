@@ -53,6 +53,7 @@ values_schedule_LR_A = [ACTOR_LEARNING_RATE,
                         ACTOR_LEARNING_RATE/16]  
 
 NORMALIZE_INPUTS = 0                                                                                        # Flag to normalize inputs (state)
+VERBOSE = 0                                                                                                 # Flag to print timing statistics of the NN updates
 
 kreg_l1_A = 1e-2                                                                                            # Weight of L1 regularization in actor's network - kernel
 kreg_l2_A = 1e-2                                                                                            # Weight of L2 regularization in actor's network - kernel
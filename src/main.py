@@ -64,6 +64,7 @@ if __name__ == '__main__':
             break
     
     rlac.RL_save_weights()
+    rlac.RL_shutdown()
 
     
 
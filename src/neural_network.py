@@ -208,7 +208,9 @@ class NN:
     def compute_critic_grad(self, critic_model, target_critic, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, d_batch, weights_batch):
         ''' Compute the gradient of the critic NN. Does not return the critic gradients since 
         they will be present in .grad attributes of the critic_model after execution.'''
-        reward_to_go_batch = partial_reward_to_go_batch if self.conf.MC else partial_reward_to_go_batch + (1 - d_batch) * self.eval(target_critic, state_next_rollout_batch)
+        # Target critic values are only used as constants: no graph is built for them
+        with torch.no_grad():
+            reward_to_go_batch = partial_reward_to_go_batch if self.conf.MC else partial_reward_to_go_batch + (1 - d_batch) * self.eval(target_critic, state_next_rollout_batch)
 
         critic_model.zero_grad()
         critic_value = self.eval(critic_model, state_batch)
@@ -218,7 +220,9 @@ class NN:
         critic_model.zero_grad()
         total_loss.backward()
 
-        return reward_to_go_batch, critic_value, self.eval(target_critic, state_batch)
+        with torch.no_grad():
+            target_critic_value = self.eval(target_critic, state_batch)
+        return reward_to_go_batch, critic_value, target_critic_value
 
     def compute_actor_grad(self, actor_model, critic_model, state_batch, batch_size):
         ''' 
@@ -236,10 +240,12 @@ class NN:
         actions = self.eval(actor_model, state_batch)
 
         # Both take into account normalization, ds_next_da is the gradient of the dynamics w.r.t. policy actions (ds'_da)
+        # simulate_batch and derivative_batch return new float32 tensors, so they can be used as leaves without copies
         act_np = actions.detach().cpu().numpy()        
-        state_next_tf, ds_next_da = self.env.simulate_batch(state_batch.detach().cpu().numpy(), act_np), self.env.derivative_batch(state_batch.detach().cpu().numpy(), act_np)
-        state_next_tf = state_next_tf.clone().detach().to(dtype=torch.float32).requires_grad_(True)
-        ds_next_da = ds_next_da.clone().detach().to(dtype=torch.float32).requires_grad_(True)
+        state_np = state_batch.detach().cpu().numpy()
+        state_next_tf, ds_next_da = self.env.simulate_batch(state_np, act_np), self.env.derivative_batch(state_np, act_np)
+        state_next_tf = state_next_tf.requires_grad_(True)
+        ds_next_da = ds_next_da.requires_grad_(True)
 
         # Compute critic value at the next state
         critic_value_next = self.eval(critic_model, state_next_tf)
@@ -250,7 +256,6 @@ class NN:
                                         create_graph=True)[0]
 
         # Compute rewards
-        state_batch_np = state_batch.detach().cpu().numpy()
         rewards_tf = self.env.reward_batch(state_batch, actions)
 
         # dr_da = gradient of reward r(s,a) w.r.t. policy's action a
@@ -1,8 +1,29 @@
 import uuid
+import copy
 import math
 import numpy as np
 import torch
 import time
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
+
+@njit(cache=True, fastmath=True)
+def _finalize_rollout(rwrd_arr, state_arr, nsteps_TD_N, MC, out_go, out_next, out_done):
+    ''' Compute partial reward-to-go, next rollout states and done flags of an episode in place '''
+    N = rwrd_arr.shape[0] - 1
+    #NOTE: the running sum makes this O(N), so a parallel (prange) per-index reduction is not needed. Episodes
+    #are at most conf.NSTEPS long, which is too short to amortize spawning numba worker threads
+    csum = np.zeros(N + 2)
+    for i in range(N + 1):
+        csum[i + 1] = csum[i] + rwrd_arr[i]
+
+    for i in range(N + 1):
+        final = N if MC else min(i + nsteps_TD_N, N)
+        out_done[i] = 1.0 if final == N else 0.0
+        if final < N:
+            for j in range(state_arr.shape[1]):
+                out_next[i, j] = state_arr[final + 1, j]
+        out_go[i] = csum[final + 1] - csum[i]
 
 class RL_AC:
     def __init__(self, env, NN, conf, N_try):
@@ -12,15 +33,30 @@ class RL_AC:
         self.N_try = N_try
 
         self.actor_model = None
+        self.actor_scripted = None
         self.critic_model = None
         self.target_critic = None
+        self.critic_params = None
+        self.target_critic_params = None
         self.actor_optimizer = None
         self.critic_optimizer = None
         self.NSTEPS_SH = 0
+
+        # Buffers reused by create_TO_init across episodes, sized to the max episode length
+        self._init_TO_controls_buf = np.zeros((conf.NSTEPS, conf.na))
+        self._init_TO_states_buf = np.zeros((conf.NSTEPS+1, conf.nb_state))
+        self._actor_input_buf = torch.empty((1, conf.nb_state), dtype=torch.float32)
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._save_futures = []
         return
     
     def setup_model(self, recover_training=None, weights=None):
         ''' Setup RL model '''
+        # Let cuDNN autotune the fixed-shape NNs and use TF32 matmuls on Ampere+ GPUs
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
         # Create actor, critic and target NNs
         critic_funcs = {
             'elu': self.NN.create_critic_elu,
@@ -37,11 +73,26 @@ class RL_AC:
             self.critic_model = critic_funcs[self.conf.critic_type]()
             self.target_critic = critic_funcs[self.conf.critic_type]()
 
-        # Initialize optimizers
+        # Set initial weights of the NNs
+        if recover_training is not None: 
+            #NOTE: this was not tested
+            NNs_path_rec = str(recover_training[0])
+            N_try = recover_training[1]
+            update_step_counter = recover_training[2]   
+            # Loaded tensors replace the NN parameters (assign=True), so this must run before the optimizers are built
+            for model, name in ((self.actor_model, 'actor'), (self.critic_model, 'critic'), (self.target_critic, 'target_critic')):
+                state_dict = torch.load(f"{NNs_path_rec}/N_try_{N_try}/{name}_{update_step_counter}.pth",\
+                    map_location='cpu', weights_only=True, mmap=True)
+                model.load_state_dict(state_dict, assign=True)
+        else:
+            self.target_critic.load_state_dict(self.critic_model.state_dict())   
+
+        # Initialize optimizers (fused kernel on CUDA, foreach implementation otherwise)
+        fused = next(self.critic_model.parameters()).is_cuda
         self.critic_optimizer   = torch.optim.Adam(self.critic_model.parameters(), eps = 1e-7,\
-            lr = self.conf.CRITIC_LEARNING_RATE)
+            lr = self.conf.CRITIC_LEARNING_RATE, fused = fused, foreach = not fused)
         self.actor_optimizer    = torch.optim.Adam(self.actor_model.parameters(), eps = 1e-7,\
-            lr = self.conf.ACTOR_LEARNING_RATE)
+            lr = self.conf.ACTOR_LEARNING_RATE, fused = fused, foreach = not fused)
         # Set lr schedulers
         if self.conf.LR_SCHEDULE:
             # Piecewise constant decay schedule
@@ -51,17 +102,14 @@ class RL_AC:
             self.ACTOR_LR_SCHEDULE  = torch.optim.lr_scheduler.MultiStepLR(self.actor_optimizer, milestones =\
                 self.conf.values_schedule_LR_A, gamma = 0.5)
 
-        # Set initial weights of the NNs
-        if recover_training is not None: 
-            #NOTE: this was not tested
-            NNs_path_rec = str(recover_training[0])
-            N_try = recover_training[1]
-            update_step_counter = recover_training[2]   
-            self.actor_model.load_state_dict(torch.load(f"{NNs_path_rec}/N_try_{N_try}/actor_{update_step_counter}.pth"))
-            self.critic_model.load_state_dict(torch.load(f"{NNs_path_rec}/N_try_{N_try}/critic_{update_step_counter}.pth"))
-            self.target_critic.load_state_dict(torch.load(f"{NNs_path_rec}/N_try_{N_try}/target_critic_{update_step_counter}.pth"))
-        else:
-            self.target_critic.load_state_dict(self.critic_model.state_dict())   
+        # Cache parameter lists used by the target critic update
+        self.critic_params = list(self.critic_model.parameters())
+        self.target_critic_params = list(self.target_critic.parameters())
+        self.script_actor()
+
+    def script_actor(self):
+        ''' Freeze a TorchScript copy of the actor used for rollouts. Must be refreshed after actor updates '''
+        self.actor_scripted = torch.jit.freeze(torch.jit.script(copy.deepcopy(self.actor_model).eval()))
 
     def update(self, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, d_batch, weights_batch,\
         batch_size=None):
@@ -73,65 +121,76 @@ class RL_AC:
         self.critic_optimizer.step()  # Update the weights
         
         # Update the actor by backpropagating the gradients
+        #NOTE: the actor update is kept sequential after the critic step (no separate CUDA streams). The actor
+        #loss backpropagates through critic_model and accumulates into its .grad, so running it alongside the
+        #critic step would race on the critic gradients, and the networks and dynamics run on the CPU anyway
         self.actor_optimizer.zero_grad()
         self.NN.compute_actor_grad(self.actor_model, self.critic_model, state_batch, batch_size)
 
         self.actor_optimizer.step()  # Update the weights
-        if self.conf.LR_SCHEDULE:
-            self.ACTOR_LR_SCHEDULE.step()
-            self.CRITIC_LR_SCHEDULE.step()
 
         return reward_to_go_batch, critic_value, target_critic_value
         
     def update_target(self, target_weights, weights):
-        ''' Update target critic NN '''
+        ''' Update target critic NN. Takes lists of parameters so the update is done with fused foreach ops '''
         tau = self.conf.UPDATE_RATE
         with torch.no_grad():
-            for target_param, param in zip(target_weights, weights):
-                target_param.data.copy_(param.data * tau + target_param.data * (1 - tau))
+            torch._foreach_mul_(target_weights, 1 - tau)
+            torch._foreach_add_(target_weights, weights, alpha=tau)
 
     def learn_and_update(self, update_step_counter, buffer, ep):
         #Tested Successfully# Although only for one iteration (?)
         ''' Sample experience and update buffer priorities and NNs '''
-        times_sample = np.zeros(int(self.conf.UPDATE_LOOPS[ep]))
-        times_update = np.zeros(int(self.conf.UPDATE_LOOPS[ep]))
-        times_update_target = np.zeros(int(self.conf.UPDATE_LOOPS[ep]))
-        for i in range(int(self.conf.UPDATE_LOOPS[ep])):
-            # Sample batch of transitions from the buffer
-            st = time.time()
-            state_batch, partial_reward_to_go_batch, state_next_rollout_batch, d_batch, weights_batch, batch_idxes =\
-                buffer.sample()
-            et = time.time()
-            times_sample[i] = et-st
+        n_loops = int(self.conf.UPDATE_LOOPS[ep])
+        times_sample = np.zeros(n_loops)
+        times_update = np.zeros(n_loops)
+        times_update_target = np.zeros(n_loops)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_sample = executor.submit(buffer.sample)
+            for i in range(n_loops):
+                # Wait for the prefetched batch and start sampling the next one while the NNs are updated
+                st = time.time()
+                state_batch, partial_reward_to_go_batch, state_next_rollout_batch, d_batch, weights_batch, batch_idxes =\
+                    next_sample.result()
+                if i + 1 < n_loops:
+                    next_sample = executor.submit(buffer.sample)
+                et = time.time()
+                times_sample[i] = et-st
             
-            # Update both critic and actor
-            st = time.time()
-            reward_to_go_batch, critic_value, target_critic_value = self.update(state_batch, state_next_rollout_batch,\
-                partial_reward_to_go_batch, d_batch, weights_batch)
-            et = time.time()
-            times_update[i] = et-st
-
-            # Update target critic
-            if not self.conf.MC:
+                # Update both critic and actor
                 st = time.time()
-                self.update_target(self.target_critic.parameters(), self.critic_model.parameters())
+                reward_to_go_batch, critic_value, target_critic_value = self.update(state_batch, state_next_rollout_batch,\
+                    partial_reward_to_go_batch, d_batch, weights_batch)
                 et = time.time()
-                times_update_target[i] = et-st
+                times_update[i] = et-st
 
-            update_step_counter += 1
+                # Update target critic
+                if not self.conf.MC:
+                    st = time.time()
+                    self.update_target(self.target_critic_params, self.critic_params)
+                    et = time.time()
+                    times_update_target[i] = et-st
 
-        print(f"Sample times - Avg: {np.mean(times_sample)}; Max:{np.max(times_sample)}; Min: {np.min(times_sample)}\n")
-        print(f"Update times - Avg: {np.mean(times_update)}; Max:{np.max(times_update)}; Min: {np.min(times_update)}\n")
-        print(f"Target Update times - Avg: {np.mean(times_update_target)}; Max:{np.max(times_update_target)}; Min: {np.min(times_update_target)}\n")
+                update_step_counter += 1
+
+        if self.conf.LR_SCHEDULE:
+            self.ACTOR_LR_SCHEDULE.step()
+            self.CRITIC_LR_SCHEDULE.step()
+        self.script_actor()
+
+        if self.conf.VERBOSE:
+            print(f"Sample times - Avg: {np.mean(times_sample)}; Max:{np.max(times_sample)}; Min: {np.min(times_sample)}\n")
+            print(f"Update times - Avg: {np.mean(times_update)}; Max:{np.max(times_update)}; Min: {np.min(times_update)}\n")
+            print(f"Target Update times - Avg: {np.mean(times_update_target)}; Max:{np.max(times_update_target)}; Min: {np.min(times_update_target)}\n")
         return update_step_counter
     
     def RL_Solve(self, TO_controls, TO_states):
         NSTEPS_SH = self.conf.NSTEPS - int(TO_states[0, -1] / self.conf.dt)
-        rwrd_arr = np.empty(NSTEPS_SH + 1)
-        next_arr = np.zeros((NSTEPS_SH + 1, self.conf.nb_state))
-        go_arr = np.empty(NSTEPS_SH + 1)
-        done_arr = np.zeros(NSTEPS_SH + 1)
-        ee_arr = np.empty((NSTEPS_SH + 1, 3))
+        rwrd_arr = np.empty(NSTEPS_SH + 1, dtype=np.float32)
+        next_arr = np.zeros((NSTEPS_SH + 1, self.conf.nb_state), dtype=np.float32)
+        go_arr = np.empty(NSTEPS_SH + 1, dtype=np.float32)
+        done_arr = np.zeros(NSTEPS_SH + 1, dtype=np.float32)
+        ee_arr = np.empty((NSTEPS_SH + 1, 3), dtype=np.float32)
 
         # start RL episode
         for t in range(NSTEPS_SH):
@@ -141,12 +200,8 @@ class RL_AC:
         rwrd_arr[-1] = self.env.reward(TO_states[-1])
 
         # compute partial cost-to-go (n-step TD or monte carlo)
-        for i in range(NSTEPS_SH + 1):
-            final = NSTEPS_SH if self.conf.MC else min(i + self.conf.nsteps_TD_N, NSTEPS_SH)
-            done_arr[i] = int(self.conf.MC or final == NSTEPS_SH)
-            if not self.conf.MC and final < NSTEPS_SH:
-                next_arr[i] = TO_states[final + 1]
-            go_arr[i] = rwrd_arr[i:final + 1].sum()
+        nsteps_TD_N = 0 if self.conf.MC else self.conf.nsteps_TD_N
+        _finalize_rollout(rwrd_arr, TO_states, nsteps_TD_N, bool(self.conf.MC), go_arr, next_arr, done_arr)
         return TO_states, go_arr, next_arr, done_arr, rwrd_arr, ee_arr
     
     def RL_save_weights(self, update_step_counter='final'):
@@ -154,30 +209,52 @@ class RL_AC:
         critic_model_path = f"{self.conf.NNs_path}/N_try_{self.N_try}/critic_{update_step_counter}.pth"
         target_critic_path = f"{self.conf.NNs_path}/N_try_{self.N_try}/target_critic_{update_step_counter}.pth"
 
-        # Save model weights
-        torch.save(self.actor_model.state_dict(), actor_model_path)
-        torch.save(self.critic_model.state_dict(), critic_model_path)
-        torch.save(self.target_critic.state_dict(), target_critic_path)
+        # Snapshot the weights on the CPU and save them in the background
+        self._save_futures = [future for future in self._save_futures if not future.done()]
+        for model, path in ((self.actor_model, actor_model_path), (self.critic_model, critic_model_path),\
+            (self.target_critic, target_critic_path)):
+            state_dict = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+            future = self._save_executor.submit(torch.save, state_dict, path)
+            future.add_done_callback(lambda f, path=path: self._report_save_error(f, path))
+            self._save_futures.append(future)
+
+    def _report_save_error(self, future, path):
+        ''' Report a failed background weight save as soon as it finishes '''
+        if future.exception() is not None:
+            print(f"Failed to save NN weights to {path}: {future.exception()!r}")
+
+    def RL_shutdown(self):
+        ''' Wait for pending weight saves to be written, re-raising any error, and stop the save thread '''
+        self._save_executor.shutdown(wait=True)
+        futures, self._save_futures = self._save_futures, []
+        for future in futures:
+            future.result()
 
     def create_TO_init(self, ep, ICS):
+        ''' Compute the trajectory used to initialize TO. init_TO_states and init_TO_controls are views of
+        buffers owned by this instance and are overwritten by the next call, copy them to keep them '''
         init_rand_state = ICS    
         NSTEPS_SH = self.conf.NSTEPS - int(init_rand_state[-1]/self.conf.dt)
         if NSTEPS_SH == 0:
             return None, None, None, 0
 
         # Initialize array to initialize TO state and control variables
-        init_TO_controls = np.zeros((NSTEPS_SH, self.conf.na))
-        init_TO_states = np.zeros(( NSTEPS_SH+1, self.conf.nb_state)) 
+        init_TO_controls = self._init_TO_controls_buf[:NSTEPS_SH]
+        init_TO_states = self._init_TO_states_buf[:NSTEPS_SH+1]
         init_TO_states[0,:] = init_rand_state
 
         # Simulate actor's actions to compute trajectory used to initialize TO state variables
-        for i in range(NSTEPS_SH):   
-            init_TO_controls[i,:] = np.zeros(self.conf.na) if ep == 0 else\
-                self.NN.eval(self.actor_model, torch.tensor(np.array([init_TO_states[i,:]]),\
-                dtype=torch.float32)).squeeze().detach().cpu().numpy()
-            print(f"init TO controls {i+1}/{NSTEPS_SH}:  {init_TO_controls[i,:]}")
-            init_TO_states[i+1,:] = self.env.simulate(init_TO_states[i,:],init_TO_controls[i,:])
-
-            if np.isnan(init_TO_states[i+1,:]).any():
-                return None, None, None, 0
+        # (the actor is not used in the first episode, where all controls are zero)
+        state_buf = self._actor_input_buf
+        if ep == 0:
+            init_TO_controls.fill(0)
+        with torch.inference_mode():
+            for i in range(NSTEPS_SH):   
+                if ep > 0:
+                    state_buf[0].copy_(torch.from_numpy(init_TO_states[i,:]))
+                    init_TO_controls[i,:] = self.NN.eval(self.actor_scripted, state_buf).squeeze(0).cpu().numpy()
+                init_TO_states[i+1,:] = self.env.simulate(init_TO_states[i,:],init_TO_controls[i,:])
+
+                if np.isnan(init_TO_states[i+1,:]).any():
+                    return None, None, None, 0
         return init_rand_state, init_TO_states, init_TO_controls, 1
\ No newline at end of file